@@ -0,0 +1,627 @@
+import streamlit as st
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from jira import JIRA, JIRAError
+from requests.adapters import HTTPAdapter
+from langchain_openai import ChatOpenAI
+from langchain_community.cache import SQLiteCache
+from langchain_core.caches import InMemoryCache
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.globals import set_llm_cache
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import PromptTemplate
+from openai import OpenAI
+
+# Shared building blocks for the Story Refiner Streamlit pages. Nothing here
+# renders at import time, so pages can still call st.set_page_config first.
+
+# ---- LLM RESPONSE CACHE ----
+# Identical (model, temperature, prompt) calls are answered from disk instead of
+# spending another OpenAI round-trip, e.g. when a story is refined twice.
+# Set LLM_CACHE_PATH="" to keep the cache in process memory only (ephemeral/read-only hosts).
+# Cached answers never expire: delete the file (default .llm_cache.db) to start over. The JSON
+# refiner bypasses it, and the Refine panel asks for a fresh answer after an unparseable one.
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", ".llm_cache.db")
+set_llm_cache(SQLiteCache(database_path=LLM_CACHE_PATH) if LLM_CACHE_PATH else InMemoryCache())
+
+# ---- PROMPTS ----
+REFINER_PROMPT = """
+You are a User Story Refiner Agent. Given a user story or backlog item (which may be unclear, incomplete, or poorly written), your tasks are:
+1. Rewrite the story for clarity and completeness using the INVEST criteria.
+2. Add actionable acceptance criteria in bullet points.
+3. Suggest improvements if information is missing.
+
+Input User Story/Backlog Item:
+{user_story}
+
+Output (in this format):
+---
+**Refined User Story:**  
+<improved version>
+
+**Acceptance Criteria:**  
+- <criterion 1>
+- <criterion 2>
+---
+"""
+
+# Bulk variant: several stories per call, so the instructions are sent once per batch
+BATCH_REFINER_PROMPT = """
+You are a User Story Refiner Agent. For EACH user story or backlog item in the JSON list below (which may be unclear, incomplete, or poorly written), your tasks are:
+1. Rewrite the story for clarity and completeness using the INVEST criteria.
+2. Add actionable acceptance criteria.
+3. Suggest improvements if information is missing.
+
+Input User Stories/Backlog Items (JSON list of objects with "id", "summary" and "description"):
+{stories_json}
+
+Output a JSON object in exactly this shape, with one entry per input story and its "id" copied unchanged:
+{{"stories": [{{"id": "<id>", "refined_summary": "<improved version>", "acceptance_criteria": ["<criterion 1>", "<criterion 2>"], "suggestions": ["<suggestion>"]}}]}}
+"""
+
+TASK_BREAKDOWN_PROMPT = """
+You are a software analyst. Given the following user story and its acceptance criteria, break it down into a clear, actionable list of implementation tasks for the development team.
+
+User Story:
+{user_story}
+
+Acceptance Criteria:
+{acceptance_criteria}
+
+Output (as a bullet list of tasks):
+-
+"""
+
+# Compiled once per process instead of on every Refine click
+REFINER_PROMPT_TEMPLATE = PromptTemplate.from_template(REFINER_PROMPT)
+BATCH_REFINER_PROMPT_TEMPLATE = PromptTemplate.from_template(BATCH_REFINER_PROMPT)
+TASK_BREAKDOWN_PROMPT_TEMPLATE = PromptTemplate.from_template(TASK_BREAKDOWN_PROMPT)
+# Stories per batched LLM call; keeps each JSON response well inside the output token limit
+BATCH_REFINE_SIZE = 10
+# Concurrent OpenAI requests when a chain runs over several inputs
+LLM_MAX_CONCURRENCY = 8
+
+# Appended to descriptions written back to Jira
+REFINED_MARKER = "_Refined by AI agent_"
+# Label added on write-back; spotting refined stories by label needs no description scan.
+# The marker is still honoured for stories refined before the label existed.
+REFINED_LABEL = "ai-refined"
+
+# ---- CACHED CLIENTS ----
+# Jira calls are independent HTTPS round-trips, so fan them out over a small pool
+JIRA_MAX_WORKERS = 8
+# Sized to cover concurrent sub-task workers so they reuse keep-alive TLS connections
+JIRA_POOL_SIZE = 16
+
+@st.cache_resource(show_spinner=False)
+def get_jira(host, email, token):
+    jira = JIRA(server=host, basic_auth=(email, token))
+    adapter = HTTPAdapter(pool_connections=JIRA_POOL_SIZE, pool_maxsize=JIRA_POOL_SIZE, max_retries=3)
+    jira._session.mount("https://", adapter)
+    jira._session.mount("http://", adapter)
+    return jira
+
+@st.cache_resource(show_spinner=False)
+def get_llm(api_key, cache=True):
+    # streaming=True emits tokens to callbacks as they arrive; cache hits still return whole
+    return ChatOpenAI(model="gpt-4o", temperature=0, api_key=api_key, streaming=True, cache=cache)
+
+@st.cache_resource(show_spinner=False)
+def get_json_llm(api_key):
+    return ChatOpenAI(
+        model="gpt-4o", temperature=0, api_key=api_key, cache=False,
+        model_kwargs={"response_format": {"type": "json_object"}},
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_openai_client(api_key):
+    return OpenAI(api_key=api_key)
+
+@st.cache_resource(show_spinner=False)
+def get_refiner_chain(api_key, cache=True):
+    return REFINER_PROMPT_TEMPLATE | get_llm(api_key, cache) | StrOutputParser()
+
+@st.cache_resource(show_spinner=False)
+def get_batch_refiner_chain(api_key):
+    return BATCH_REFINER_PROMPT_TEMPLATE | get_json_llm(api_key) | StrOutputParser()
+
+@st.cache_resource(show_spinner=False)
+def get_task_breakdown_chain(api_key):
+    return TASK_BREAKDOWN_PROMPT_TEMPLATE | get_llm(api_key) | StrOutputParser()
+
+# ---- CACHED JIRA DATA ----
+def _issue_to_dict(issue):
+    """Flatten a Jira issue into a plain, picklable dict for st.cache_data.
+
+    Reads the raw JSON so fields left out of the search's fields= list just come back empty.
+    """
+    fields = issue.raw["fields"]
+    description = fields.get("description") or ""
+    labels = fields.get("labels") or []
+    return {
+        "key": issue.key,
+        "summary": fields.get("summary") or "",
+        "description": description,
+        "labels": labels,
+        # Decided once here and cached, rather than on every rerun of the picker
+        "refined": REFINED_LABEL in labels or REFINED_MARKER in description,
+        "issuetype": (fields.get("issuetype") or {}).get("name", ""),
+        "subtasks": [subtask["key"] for subtask in fields.get("subtasks") or []],
+    }
+
+@st.cache_data(ttl=60, show_spinner=False)
+def load_issues(host, email, token, project_key, only_unrefined=False, fields="summary,description,issuetype,labels"):
+    jira = get_jira(host, email, token)
+    jql = f'project={project_key}'
+    if only_unrefined:
+        # Let Jira drop already-refined issues instead of fetching and discarding them
+        jql += (
+            f' AND (labels is EMPTY OR labels != "{REFINED_LABEL}")'
+            ' AND (description is EMPTY OR description !~ "\\"Refined by AI agent\\"")'
+        )
+    jql += ' ORDER BY created ASC'
+    issues = jira.search_issues(jql, maxResults=20, fields=fields)
+    return [_issue_to_dict(i) for i in issues]
+
+def story_input_for(issue):
+    """The text sent to the refiner for an issue dict."""
+    return f"{issue['summary']}\n\n{issue['description']}".strip()
+
+# ---- REFINED OUTPUT ----
+_SECTION_RE = re.compile(
+    # A --- rule may sit between the sections as well as after them
+    r"\*\*Refined User Story:\*\*\s*(.*?)\s*(?:\n---\s*)?\*\*Acceptance Criteria:\*\*\s*(.*?)\s*(?:\n---|\Z)",
+    re.DOTALL,
+)
+# Fallback when the model leaves out the Acceptance Criteria section entirely
+_SUMMARY_ONLY_RE = re.compile(r"\*\*Refined User Story:\*\*\s*(.*?)\s*(?:\n---|\Z)", re.DOTALL)
+# \r included so \r\n output comes back with plain \n line breaks
+_LINE_EDGE_RE = re.compile(r"[ \t\r]*\n[ \t]*")
+
+def parse_refined_output(output):
+    r"""Split the refiner's markdown into (summary, acceptance criteria) in one regex pass.
+
+    Text on the same line as a header is kept, a --- rule may separate the sections, and the
+    criteria end at the first line starting with ---, so only the first refinement block is
+    read. A missing criteria header still yields the summary, with empty criteria:
+
+    >>> parse_refined_output("**Refined User Story:**\nS\n---\n**Acceptance Criteria:**\n- a")
+    ('S', '- a')
+    >>> parse_refined_output("**Refined User Story:**\r\nS\r\n\r\n**Acceptance Criteria:**\r\n- a\r\n- b\r\n---")
+    ('S', '- a\n- b')
+    >>> parse_refined_output("**Refined User Story:** S\n---")
+    ('S', '')
+    """
+    match = _SECTION_RE.search(output)
+    if not match:
+        match = _SUMMARY_ONLY_RE.search(output)
+        return (" ".join(match.group(1).split()), "") if match else ("", "")
+    summary, criteria = match.groups()
+    # The pattern already trims both sections' outer whitespace; only inner runs are left
+    return " ".join(summary.split()), _LINE_EDGE_RE.sub("\n", criteria)
+
+def render_refined_output(refined_summary, refined_criteria):
+    """Render a parsed refinement (summary, criteria and optional suggestions)."""
+    st.markdown(f"**Refined Summary:** {refined_summary}")
+    st.markdown("**Acceptance Criteria:**")
+    if "**Suggestions for Improvement:**" in refined_criteria:
+        criteria_part, suggestions_part = refined_criteria.split("**Suggestions for Improvement:**", 1)
+        st.markdown(bullet_criteria(criteria_part))
+        st.markdown("**Suggestions for Improvement:**")
+        st.markdown(bullet_criteria(suggestions_part))
+    else:
+        st.markdown(bullet_criteria(refined_criteria))
+
+class TokenBuffer(BaseCallbackHandler):
+    """Collect streamed LLM tokens so whichever script run is waiting on the call can show them."""
+
+    def __init__(self):
+        self.tokens = []
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.tokens.append(token)
+
+def bullet_criteria(refined_criteria):
+    """Acceptance criteria as the markdown bullet list written to Jira."""
+    lines = [line for line in refined_criteria.splitlines() if line]
+    return "- " + "\n- ".join(lines) if lines else ""
+
+def build_refined_description(refined_summary, criteria_bulleted, marker=REFINED_MARKER):
+    """Jira description written back for a refined story; criteria_bulleted comes from bullet_criteria()."""
+    return (
+        f"**Refined User Story:**  {refined_summary}\n\n"
+        f"**Acceptance Criteria:**  \n{criteria_bulleted}\n\n{marker}"
+    )
+
+def _is_str_list(value):
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+def _parse_batch_refined_output(output):
+    """Map each story id in a batch JSON response to (refined_summary, refined_criteria).
+
+    Raises ValueError if the response has no "stories" list; a story with missing or mistyped
+    fields maps to a ValueError of its own, so only that story is reported as failed.
+    """
+    data = json.loads(output)
+    stories = data.get("stories") if isinstance(data, dict) else None
+    if not isinstance(stories, list) or not all(isinstance(story, dict) for story in stories):
+        raise ValueError('expected {"stories": [...]} with one object per story')
+    results = {}
+    for story in stories:
+        summary = story.get("refined_summary")
+        criteria = story.get("acceptance_criteria", [])
+        suggestions = story.get("suggestions", [])
+        if not isinstance(summary, str) or not summary.strip():
+            results[str(story.get("id"))] = ValueError("refined_summary is missing or empty")
+        elif not _is_str_list(criteria) or not _is_str_list(suggestions):
+            results[str(story.get("id"))] = ValueError("acceptance_criteria and suggestions must be lists of strings")
+        else:
+            criteria = "\n".join(criteria)
+            if suggestions:
+                criteria += "\n**Suggestions for Improvement:**\n" + "\n".join(suggestions)
+            results[str(story.get("id"))] = (summary, criteria)
+    return results
+
+async def refine_stories(chain, issues, batch_size=BATCH_REFINE_SIZE):
+    """Refine issues batch_size stories per LLM call, with up to LLM_MAX_CONCURRENCY calls in flight.
+
+    Returns {issue_key: (refined_summary, refined_criteria)}; every issue of a failed call, and any story
+    whose fields don't validate, maps to its exception instead.
+    """
+    batches = [issues[start:start + batch_size] for start in range(0, len(issues), batch_size)]
+    outputs = await chain.abatch(
+        [
+            {"stories_json": json.dumps([
+                {"id": issue["key"], "summary": issue["summary"], "description": issue["description"]}
+                for issue in batch
+            ])}
+            for batch in batches
+        ],
+        config={"max_concurrency": LLM_MAX_CONCURRENCY},
+        return_exceptions=True,
+    )
+    results = {}
+    for batch, output in zip(batches, outputs):
+        if not isinstance(output, Exception):
+            try:
+                results.update(_parse_batch_refined_output(output))
+                continue
+            except (ValueError, AttributeError, TypeError) as e:
+                output = e
+        for issue in batch:
+            results[issue["key"]] = output
+    return results
+
+# ---- OPENAI BATCH API (BULK REFINE AT HALF PRICE) ----
+def submit_refine_batch(api_key, issues):
+    """Queue one JSON-mode refinement per issue on the OpenAI Batch API and return the batch id."""
+    requests_jsonl = "\n".join(
+        json.dumps({
+            "custom_id": issue["key"],
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": "gpt-4o",
+                "temperature": 0,
+                "response_format": {"type": "json_object"},
+                "messages": [
+                    {"role": "user", "content": BATCH_REFINER_PROMPT_TEMPLATE.format(stories_json=json.dumps([
+                        {"id": issue["key"], "summary": issue["summary"], "description": issue["description"]}
+                    ]))}
+                ],
+            },
+        })
+        for issue in issues
+    )
+    client = get_openai_client(api_key)
+    batch_file = client.files.create(file=("refine_batch.jsonl", requests_jsonl.encode("utf-8")), purpose="batch")
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    return batch.id
+
+# A batch in any of these states will not change any more; whatever output it has is final
+BATCH_FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+def collect_refine_batch(api_key, batch_id):
+    """Return (status, refined, failed) for a queued refine batch.
+
+    refined maps issue keys to (refined_summary, refined_criteria) and failed maps issue keys
+    (or the batch id, for batch-level errors) to a reason. Both stay empty until the batch reaches
+    a final status; expired or cancelled batches still return the requests that did finish.
+    """
+    client = get_openai_client(api_key)
+    batch = client.batches.retrieve(batch_id)
+    refined, failed = {}, {}
+    if batch.status not in BATCH_FINAL_STATUSES:
+        return batch.status, refined, failed
+    batch_errors = [error.message for error in getattr(batch.errors, "data", None) or []]
+    if batch_errors:
+        failed[batch_id] = "; ".join(batch_errors)
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        for line in client.files.content(file_id).text.splitlines():
+            record = json.loads(line)
+            issue_key = record["custom_id"]
+            response = record.get("response") or {}
+            if response.get("status_code") != 200:
+                error = record.get("error") or (response.get("body") or {}).get("error") or {}
+                failed[issue_key] = (
+                    f"request failed ({response.get('status_code', 'no response')}): "
+                    f"{error.get('message', 'no details')}"
+                )
+                continue
+            try:
+                parsed = _parse_batch_refined_output(response["body"]["choices"][0]["message"]["content"])
+            except (ValueError, AttributeError, TypeError) as e:
+                failed[issue_key] = f"could not parse the refined output: {e}"
+                continue
+            if issue_key not in parsed:
+                failed[issue_key] = "the model returned no refinement for this story"
+            elif isinstance(parsed[issue_key], Exception):
+                failed[issue_key] = f"could not parse the refined output: {parsed[issue_key]}"
+            else:
+                refined[issue_key] = parsed[issue_key]
+    return batch.status, refined, failed
+
+# ---- SESSION / CONNECTION ----
+CONNECTION_STATE_KEYS = [
+    "jira_host", "jira_email", "jira_api_token", "jira_project_key",
+    "connected", "last_refined_summary",
+    "last_refined_criteria", "last_criteria_bulleted", "last_selected_issue_key"
+]
+
+def clear_connection_state(extra_keys=()):
+    # Drop only this session's Jira client so the next connect starts fresh; the
+    # cache_resource store is shared with every other session
+    if st.session_state.get("jira_host"):
+        get_jira.clear(
+            st.session_state["jira_host"], st.session_state["jira_email"], st.session_state["jira_api_token"]
+        )
+    for k in [*CONNECTION_STATE_KEYS, *extra_keys]:
+        if k in st.session_state:
+            del st.session_state[k]
+
+def render_connection(with_openai_key=False, extra_state_keys=()):
+    """Render the Disconnect button, or the connection form until connected. Returns True once connected."""
+    # --- DISCONNECT BUTTON (TOP RIGHT IF CONNECTED) ---
+    if st.session_state.get("connected", False):
+        colc, cold = st.columns([10, 1])
+        with cold:
+            if st.button("Disconnect"):
+                clear_connection_state(extra_state_keys)
+                st.rerun()
+
+    # ---- Step 1: Connection Form ----
+    if not st.session_state.get("connected", False):
+        st.subheader("Connect to Jira & OpenAI" if with_openai_key else "Connect to Jira")
+        with st.form("connection_form"):
+            jira_host = st.text_input("Jira Host URL (e.g. https://yourdomain.atlassian.net)", value=st.session_state.get("jira_host", ""))
+            jira_email = st.text_input("Jira Email", value=st.session_state.get("jira_email", ""))
+            jira_api_token = st.text_input("Jira API Token", type="password", value=st.session_state.get("jira_api_token", ""))
+            jira_project_key = st.text_input("Jira Project Key", value=st.session_state.get("jira_project_key", ""))
+            openai_api_key = None
+            if with_openai_key:
+                openai_api_key = st.text_input("OpenAI API Key", type="password", value=st.session_state.get("openai_api_key", ""))
+            submitted = st.form_submit_button("Connect")
+
+        if submitted:
+            # Basic validation
+            required = [jira_host, jira_email, jira_api_token, jira_project_key]
+            if with_openai_key:
+                required.append(openai_api_key)
+            if not all(required):
+                st.warning("Please fill in all fields to connect.")
+            else:
+                st.session_state["jira_host"] = jira_host.strip()
+                st.session_state["jira_email"] = jira_email.strip()
+                st.session_state["jira_api_token"] = jira_api_token.strip()
+                st.session_state["jira_project_key"] = jira_project_key.strip()
+                if with_openai_key:
+                    st.session_state["openai_api_key"] = openai_api_key.strip()
+                # Try connection immediately
+                try:
+                    get_jira(
+                        st.session_state["jira_host"],
+                        st.session_state["jira_email"],
+                        st.session_state["jira_api_token"],
+                    )
+                    st.session_state["connected"] = True
+                    st.success(f"Connected as {jira_email} to JIRA: {jira_project_key}")
+                except Exception as e:
+                    st.session_state["connected"] = False
+                    st.error(f"Failed to connect to Jira: {e}")
+    else:
+        # Connected UI banner
+        st.success(
+            f"Connected as {st.session_state['jira_email']} to JIRA: {st.session_state['jira_project_key']}",
+            icon="🔗"
+        )
+    return st.session_state.get("connected", False)
+
+# ---- JIRA WRITE-BACK ----
+def put_issue_fields(jira, issue_key, fields, add_labels=()):
+    """PUT just the given fields, skipping the GET before and the reload after that Issue.update() does.
+
+    add_labels are appended to the issue's existing labels rather than replacing them. If Jira
+    rejects the request (e.g. labels aren't on the edit screen), the fields are sent again on
+    their own. Returns True if the labels were applied too.
+    """
+    url = jira._get_url(f"issue/{issue_key}")
+    if add_labels:
+        try:
+            jira._session.put(url, data=json.dumps({
+                "fields": fields,
+                "update": {"labels": [{"add": label} for label in add_labels]},
+            }))
+            return True
+        except JIRAError as e:
+            if e.status_code != 400:
+                raise
+    jira._session.put(url, data=json.dumps({"fields": fields}))
+    return not add_labels
+
+def update_issue_if_changed(jira, issue, summary, description):
+    """Update the issue's summary/description, skipping the PUT when nothing would change.
+
+    Compares against the issue dict, which is updated after each push, so re-clicking Update
+    Jira is free, yet a story reloaded after someone edited it in Jira is pushed again.
+    Returns True if Jira was updated.
+    """
+    summary = summary[:255]
+    if summary == issue["summary"] and description == issue["description"]:
+        return False
+    labelled = put_issue_fields(
+        jira, issue["key"], {"summary": summary, "description": description}, add_labels=[REFINED_LABEL]
+    )
+    # Keep the dict in step with Jira for fragment reruns that reuse it
+    issue["summary"], issue["description"] = summary, description
+    if labelled and REFINED_LABEL not in issue["labels"]:
+        issue["labels"] = [*issue["labels"], REFINED_LABEL]
+    issue["refined"] = True
+    return True
+
+def write_refined_issues(jira, refined):
+    """PUT each {issue_key: (summary, criteria)} refinement concurrently; returns the updated keys."""
+    payloads = {
+        issue_key: {
+            "summary": refined_summary[:255],
+            "description": build_refined_description(refined_summary, bullet_criteria(refined_criteria)),
+        }
+        for issue_key, (refined_summary, refined_criteria) in refined.items()
+    }
+    if not payloads:
+        return []
+    updated_keys = []
+    with ThreadPoolExecutor(max_workers=min(JIRA_MAX_WORKERS, len(payloads))) as executor:
+        futures = {
+            executor.submit(put_issue_fields, jira, issue_key, fields, add_labels=[REFINED_LABEL]): issue_key
+            for issue_key, fields in payloads.items()
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+                updated_keys.append(futures[future])
+            except Exception as e:
+                st.error(f"Failed to update {futures[future]}: {e}")
+    return sorted(updated_keys)
+
+def render_bulk_refine_results(jira, state_key):
+    """Render the bulk refinement stored under state_key and offer to write the successful ones to Jira.
+
+    The page stores (issues, results) from refine_stories there, so the results survive the rerun
+    that the Write to Jira click triggers.
+    """
+    if state_key not in st.session_state:
+        return
+    issues, results = st.session_state[state_key]
+    refined = {}
+    for issue in issues:
+        with st.expander(f"{issue['key']}: {issue['summary']}"):
+            result = results.get(issue["key"])
+            if isinstance(result, Exception):
+                st.error(f"OpenAI Error: {result}")
+            elif result is None:
+                st.warning("The model returned no refinement for this story.")
+            else:
+                render_refined_output(*result)
+                refined[issue["key"]] = result
+    if refined and st.button(f"📌 Write {len(refined)} refined stories to Jira", key=f"{state_key}_write"):
+        updated_keys = write_refined_issues(jira, refined)
+        del st.session_state[state_key]
+        load_issues.clear()
+        st.success(f"Updated in Jira: {', '.join(updated_keys) or 'none'}")
+
+# ---- IN-FLIGHT REFINEMENTS ----
+# Module-level, so they outlive reruns and are untouched by any session's cache clears
+_REFINE_EXECUTOR = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY)
+_INFLIGHT_REFINEMENTS = {}
+_INFLIGHT_LOCK = threading.Lock()
+
+def refine_story(openai_api_key, story_input, placeholder, use_cache=True):
+    """Run the refiner chain, streaming into placeholder, and return its output.
+
+    The call runs off the script thread, so a rerun (e.g. a double-clicked Refine) doesn't abort
+    it; an identical request that is still in flight is joined instead of being sent again.
+    use_cache=False skips the LLM response cache and asks the model again.
+    """
+    request_key = (openai_api_key, story_input, use_cache)
+    with _INFLIGHT_LOCK:
+        entry = _INFLIGHT_REFINEMENTS.get(request_key)
+        if entry is None:
+            buffer = TokenBuffer()
+            future = _REFINE_EXECUTOR.submit(
+                get_refiner_chain(openai_api_key, use_cache).invoke,
+                {"user_story": story_input},
+                config={"callbacks": [buffer]},
+            )
+            entry = _INFLIGHT_REFINEMENTS[request_key] = (future, buffer)
+            future.add_done_callback(lambda _: _INFLIGHT_REFINEMENTS.pop(request_key, None))
+    future, buffer = entry
+    while not wait([future], timeout=0.1).done:
+        placeholder.markdown("".join(buffer.tokens))
+    return future.result()
+
+# ---- REFINE PANEL ----
+def require_openai_key(openai_api_key):
+    """True if an OpenAI key is available; otherwise show an error where the AI action was requested."""
+    if not openai_api_key:
+        st.error("No OpenAI API key is configured, so AI features are unavailable.")
+    return bool(openai_api_key)
+
+def render_refine_panel(jira, selected_issue, story_input, openai_api_key):
+    """Render the Refine form and, once a refinement exists for this story, the Update Jira button."""
+    with st.form("refine_form", clear_on_submit=True):
+        submitted = st.form_submit_button("🔁 Refine Story")
+        if submitted and require_openai_key(openai_api_key):
+            with st.spinner("Refining with AI..."):
+                # One slot: tokens stream into it, then the parsed sections replace them in place
+                output_box = st.empty()
+                # Stories whose cached answer didn't parse go to the model again, not the cache
+                uncached_inputs = st.session_state.setdefault("uncached_refine_inputs", set())
+                try:
+                    refined = refine_story(
+                        openai_api_key, story_input, output_box,
+                        use_cache=story_input not in uncached_inputs,
+                    )
+                except Exception as e:
+                    st.error(f"OpenAI Error: {e}")
+                    refined = ""
+                refined_summary, refined_criteria = parse_refined_output(refined)
+                if refined and not refined_summary:
+                    uncached_inputs.add(story_input)
+                    st.warning("Couldn't read the refined story; Refine again for a fresh answer.")
+                with output_box.container():
+                    render_refined_output(refined_summary, refined_criteria)
+                # Store for update
+                st.session_state["last_refined_summary"] = refined_summary
+                st.session_state["last_refined_criteria"] = refined_criteria
+                # Bulleted once here so every Update button just concatenates it
+                st.session_state["last_criteria_bulleted"] = bullet_criteria(refined_criteria)
+                st.session_state["last_selected_issue_key"] = selected_issue['key']
+
+    # Show Update Jira if a refined output is present for this story
+    if (
+        st.session_state.get("last_refined_summary")
+        and st.session_state.get("last_selected_issue_key") == selected_issue['key']
+    ):
+        if st.button("📌 Update Jira", key="update_jira_btn"):
+            refined_description = build_refined_description(
+                st.session_state['last_refined_summary'], st.session_state['last_criteria_bulleted']
+            )
+            try:
+                if update_issue_if_changed(
+                    jira, selected_issue, st.session_state['last_refined_summary'], refined_description
+                ):
+                    load_issues.clear()
+                    st.success(f"Issue {selected_issue['key']} updated in Jira!")
+                else:
+                    st.info("No changes to push.")
+            except Exception as e:
+                st.error(f"Failed to update Jira: {e}")